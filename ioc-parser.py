@@ -44,8 +44,14 @@ import os
 import sys
 import fnmatch
 import argparse
+import contextlib
+import mmap
 import re
+import shutil
+import tempfile
 from io import StringIO
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import configparser as ConfigParser
@@ -71,11 +77,17 @@ try:
 except ImportError:
     pass
 try:
-    from bs4 import BeautifulSoup
+    from bs4 import BeautifulSoup, Comment
 
     IMPORTS.append("beautifulsoup")
 except ImportError:
     pass
+try:
+    import lxml
+
+    IMPORTS.append("lxml")
+except ImportError:
+    pass
 try:
     import requests
 
@@ -83,10 +95,87 @@ try:
 except ImportError:
     pass
 
+# Prefer faster regular expression engines if available
+try:
+    import regex as text_re
+except ImportError:
+    import re as text_re
+
+# re2 runs in linear time, but its \b, \w, \s and \d only match ASCII
+# characters, so it is only used for the patterns and whitelists that are
+# matched against bytes. There it has to read the bytes as Latin-1 instead of
+# UTF-8, and since its \s leaves out \v, \s and \S are spelled as the POSIX
+# class, which includes it.
+try:
+    import re2
+
+    RE2_OPTIONS = re2.Options()
+    RE2_OPTIONS.encoding = re2.Options.Encoding.LATIN1
+
+    def compile_bytes(pattern):
+        tokens = []
+        in_class = False
+        for token in re.findall(rb"\\.|\[\^?\]?|.", pattern, re.DOTALL):
+            if token in (rb"\s", rb"\S"):
+                token = b"[:space:]" if token == rb"\s" else b"[:^space:]"
+                if not in_class:
+                    token = b"[" + token + b"]"
+            elif token.startswith(b"\\"):
+                pass
+            elif in_class:
+                in_class = not token.endswith(b"]")
+            elif token.startswith(b"["):
+                # A ] right after [ or [^ is part of the class
+                in_class = True
+            tokens.append(token)
+        return re2.compile(b"".join(tokens), RE2_OPTIONS)
+
+except ImportError:
+    compile_bytes = text_re.compile
+
 # Import additional project source files
 import output
 from whitelist import WhiteList
 
+# Non-ASCII whitespace (all below U+3001) becomes a space, as bytes patterns
+# only treat ASCII characters as whitespace
+WHITESPACE = str.maketrans(
+    dict(
+        (c, " ")
+        for c in range(0x3001)
+        if chr(c).isspace() and chr(c) not in " \t\n\r\f\v"
+    )
+)
+
+
+def text_to_data(text):
+    """Prepare extracted text for parse_page.
+
+    ASCII text is scanned as bytes, which is faster. Other text stays str, since
+    bytes patterns only treat ASCII characters as word characters.
+    """
+    text = text.translate(WHITESPACE)
+    if text.isascii():
+        return text.encode("ascii")
+    return text
+
+
+@contextlib.contextmanager
+def map_file(fpath):
+    """Open a file as a read-only memory map, or as a plain file if it cannot be."""
+    with open(fpath, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and some special files cannot be mapped
+            data = None
+
+        if data is None:
+            yield f
+        else:
+            with data:
+                yield data
+
 
 class IOC_Parser(object):
     patterns = {}
@@ -98,11 +187,15 @@ class IOC_Parser(object):
         output_format="csv",
         dedup=False,
         library="pypdf2",
+        workers=None,
     ):
         basedir = os.path.dirname(os.path.abspath(__file__))
         self.load_patterns(patterns_ini)
-        self.whitelist = WhiteList(basedir)
+        self.whitelist = WhiteList(basedir, compile_bytes)
+        output_format = output.getFormat(output_format)
         self.handler = output.getHandler(output_format)
+        self.config = (patterns_ini, input_format, output_format, dedup, library)
+        self.workers = workers
         self.dedup = dedup
 
         self.ext_filter = "*." + input_format
@@ -118,16 +211,32 @@ class IOC_Parser(object):
             if library not in IMPORTS:
                 e = "Selected PDF parser library not found: %s" % (library)
                 raise ImportError(e)
+
+            # The library is fixed for the parser's lifetime, so resolve it once
+            try:
+                self.pdf_backend = getattr(self, "parse_pdf_" + library)
+            except AttributeError:
+                e = "Selected PDF parser library is not supported: %s" % (library)
+                raise NotImplementedError(e)
+            self.parser_func = self.pdf_backend
+
+            if library == "pdfminer":
+                self.laparams = LAParams()
+                self.laparams.all_texts = True
         elif input_format == "html":
             if "beautifulsoup" not in IMPORTS:
                 e = "HTML parser library not found: BeautifulSoup"
                 raise ImportError(e)
+            self.html_parser = "lxml" if "lxml" in IMPORTS else "html.parser"
 
     def load_patterns(self, fpath):
         config = ConfigParser.ConfigParser()
         with open(fpath) as f:
             config.read_file(f)
 
+        self.text_patterns = {}
+        self.pattern_literals = {}
+        self.text_literals = {}
         for ind_type in config.sections():
             try:
                 ind_pattern = config.get(ind_type, "pattern")
@@ -135,48 +244,85 @@ class IOC_Parser(object):
                 continue
 
             if ind_pattern:
-                ind_regex = re.compile(ind_pattern)
+                ind_regex = compile_bytes(ind_pattern.encode("utf-8"))
                 self.patterns[ind_type] = ind_regex
+                self.text_patterns[ind_type] = text_re.compile(ind_pattern)
+
+            # Optional substrings of which every match contains at least one
+            if config.has_option(ind_type, "literals"):
+                literals = config.get(ind_type, "literals").split(",")
+                literals = [lit.strip() for lit in literals]
+                self.text_literals[ind_type] = literals
+                self.pattern_literals[ind_type] = [
+                    lit.encode("utf-8") for lit in literals
+                ]
+
+    def get_patterns(self, data):
+        if isinstance(data, str):
+            patterns, pattern_literals = self.text_patterns, self.text_literals
+        else:
+            patterns, pattern_literals = self.patterns, self.pattern_literals
+
+        # Leave out the types whose literals do not occur in the text at all.
+        # A substring search is much cheaper than running their patterns.
+        for ind_type, ind_regex in patterns.items():
+            literals = pattern_literals.get(ind_type)
+            if literals and all(data.find(lit) == -1 for lit in literals):
+                continue
+            yield ind_type, ind_regex
 
     def is_whitelisted(self, ind_match, ind_type):
-        for w in self.whitelist[ind_type]:
-            if w.findall(ind_match):
-                return True
-
-        return False
+        w = self.whitelist.get(ind_type)
+        if w is None:
+            return False
+
+        return w.search(ind_match) is not None
+
+    def find_matches(self, data):
+        # Each type is matched on its own, as indicators of different types
+        # may overlap (e.g. the host of a URL)
+        encode = isinstance(data, str)
+        for ind_type, ind_regex in self.get_patterns(data):
+            for match in ind_regex.finditer(data):
+                ind_match = match.group()
+                # Whitelists and deduplication work on bytes
+                if encode:
+                    ind_match = ind_match.encode("utf-8", "ignore")
+                yield ind_type, ind_match
 
     def parse_page(self, fpath, data, page_num):
-        for ind_type, ind_regex in list(self.patterns.items()):
-            matches = ind_regex.findall(data)
+        # Attributes used for every match are looked up once per page
+        is_whitelisted = self.is_whitelisted
+        print_match = self.handler.print_match
+        dedup_store = self.dedup_store if self.dedup else None
 
-            for ind_match in matches:
-                if isinstance(ind_match, tuple):
-                    ind_match = ind_match[0]
+        for ind_type, ind_match in self.find_matches(data):
+            if is_whitelisted(ind_match, ind_type):
+                continue
 
-                if self.is_whitelisted(ind_match, ind_type):
+            if dedup_store is not None:
+                seen = dedup_store[ind_type]
+                if ind_match in seen:
                     continue
 
-                if self.dedup:
-                    if (ind_type, ind_match) in self.dedup_store:
-                        continue
+                seen.add(ind_match)
 
-                    self.dedup_store.add((ind_type, ind_match))
-
-                self.handler.print_match(fpath, page_num, ind_type, ind_match)
+            ind_match = ind_match.decode("utf-8", "replace")
+            print_match(fpath, page_num, ind_type, ind_match)
 
     def parse_pdf_pypdf2(self, f, fpath):
         try:
             pdf = PdfFileReader(f, strict=False)
 
             if self.dedup:
-                self.dedup_store = set()
+                self.dedup_store = defaultdict(set)
 
             self.handler.print_header(fpath)
             page_num = 0
             for page in pdf.pages:
                 page_num += 1
 
-                data = page.extractText()
+                data = text_to_data(page.extractText())
 
                 self.parse_page(fpath, data, page_num)
             self.handler.print_footer(fpath)
@@ -187,49 +333,53 @@ class IOC_Parser(object):
 
     def parse_pdf_pdfminer(self, f, fpath):
         try:
-            laparams = LAParams()
-            laparams.all_texts = True
+            # The layout parameters are shared by all files. The resource
+            # manager is not: its font cache is keyed by object IDs, which are
+            # only unique within one document. CMaps are cached by pdfminer
+            # across resource managers anyway.
+            laparams = self.laparams
             rsrcmgr = PDFResourceManager()
             pagenos = set()
 
             if self.dedup:
-                self.dedup_store = set()
+                self.dedup_store = defaultdict(set)
 
-            self.handler.print_header(fpath)
-            page_num = 0
-            for page in PDFPage.get_pages(f, pagenos, check_extractable=True):
-                page_num += 1
-
-                retstr = StringIO()
-                device = TextConverter(rsrcmgr, retstr, laparams=laparams)
+            # One text device is shared by all pages, its buffer is emptied
+            # after each page
+            retstr = StringIO()
+            device = TextConverter(rsrcmgr, retstr, laparams=laparams)
+            try:
                 interpreter = PDFPageInterpreter(rsrcmgr, device)
-                interpreter.process_page(page)
-                data = retstr.getvalue()
-                retstr.close()
 
-                self.parse_page(fpath, data, page_num)
-            self.handler.print_footer(fpath)
+                self.handler.print_header(fpath)
+                page_num = 0
+                for page in PDFPage.get_pages(f, pagenos, check_extractable=True):
+                    page_num += 1
+
+                    interpreter.process_page(page)
+                    data = text_to_data(retstr.getvalue())
+                    retstr.seek(0)
+                    retstr.truncate(0)
+
+                    self.parse_page(fpath, data, page_num)
+                self.handler.print_footer(fpath)
+            finally:
+                device.close()
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception as e:
             self.handler.print_error(fpath, e)
 
     def parse_pdf(self, f, fpath):
-        parser_format = "parse_pdf_" + self.library
-        try:
-            self.parser_func = getattr(self, parser_format)
-        except AttributeError:
-            e = "Selected PDF parser library is not supported: %s" % (self.library)
-            raise NotImplementedError(e)
-
-        self.parser_func(f, fpath)
+        self.pdf_backend(f, fpath)
 
     def parse_txt(self, f, fpath):
         try:
             if self.dedup:
-                self.dedup_store = set()
+                self.dedup_store = defaultdict(set)
 
-            data = f.read()
+            # Mapped files are scanned in place
+            data = f if isinstance(f, mmap.mmap) else f.read()
             self.handler.print_header(fpath)
             self.parse_page(fpath, data, 1)
             self.handler.print_footer(fpath)
@@ -241,35 +391,87 @@ class IOC_Parser(object):
     def parse_html(self, f, fpath):
         try:
             if self.dedup:
-                self.dedup_store = set()
+                self.dedup_store = defaultdict(set)
 
             data = f.read()
-            soup = BeautifulSoup(data)
-            html = soup.findAll(text=True)
-
-            text = ""
-            for elem in html:
-                if elem.parent.name in [
-                    "style",
-                    "script",
-                    "[document]",
-                    "head",
-                    "title",
-                ]:
-                    continue
-                elif re.match("<!--.*-->", str(elem)):
-                    continue
-                else:
-                    text += str(elem)
+            soup = BeautifulSoup(data, self.html_parser)
+            for elem in soup(["style", "script", "head", "title"]):
+                elem.decompose()
+            for elem in soup.find_all(string=lambda s: isinstance(s, Comment)):
+                elem.extract()
+            # Text outside of any element
+            for elem in soup.find_all(string=True, recursive=False):
+                elem.extract()
+
+            text = soup.get_text()
 
             self.handler.print_header(fpath)
-            self.parse_page(fpath, text, 1)
+            self.parse_page(fpath, text_to_data(text), 1)
             self.handler.print_footer(fpath)
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception as e:
             self.handler.print_error(fpath, e)
 
+    def find_files(self, path):
+        # Like os.walk, the files of a directory come before its
+        # subdirectories, unreadable directories are skipped, entries that
+        # cannot be checked count as files and symbolic links to directories
+        # are not followed
+        try:
+            with os.scandir(path) as entries:
+                entries = list(entries)
+        except OSError:
+            return
+
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if not is_dir:
+                if fnmatch.fnmatch(entry.name, self.ext_filter):
+                    yield entry.path
+                continue
+
+            try:
+                is_symlink = entry.is_symlink()
+            except OSError:
+                is_symlink = False
+
+            if not is_symlink:
+                subdirs.append(entry.path)
+
+        for subdir in subdirs:
+            yield from self.find_files(subdir)
+
+    def parse_file(self, fpath):
+        # Errors are reported per file so the remaining files are still parsed
+        try:
+            with map_file(fpath) as f:
+                self.parser_func(f, fpath)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            self.handler.print_error(fpath, e)
+
+    def parse_files(self, fpaths):
+        if self.workers == 1 or len(fpaths) < 2:
+            for fpath in fpaths:
+                self.parse_file(fpath)
+            return
+
+        # Files are independent, so they are parsed in worker processes. Each
+        # worker buffers the output of a file, which is written here in the
+        # original file order.
+        with ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker, initargs=(self.config,)
+        ) as executor:
+            for output_data in executor.map(parse_worker, fpaths, chunksize=4):
+                sys.stdout.write(output_data)
+
     def parse(self, path):
         try:
             if path.startswith("http://") or path.startswith("https://"):
@@ -277,21 +479,21 @@ class IOC_Parser(object):
                     e = "HTTP library not found: requests"
                     raise ImportError(e)
                 headers = {"User-Agent": "Mozilla/5.0 Gecko Firefox"}
-                r = requests.get(path, headers=headers)
-                r.raise_for_status()
-                f = StringIO(r.content)
-                self.parser_func(f, path)
+                with requests.get(path, headers=headers, stream=True) as r:
+                    r.raise_for_status()
+                    r.raw.decode_content = True
+                    # Large reports are spooled to disk instead of memory
+                    with tempfile.SpooledTemporaryFile(max_size=16 << 20) as f:
+                        shutil.copyfileobj(r.raw, f)
+                        f.seek(0)
+                        self.parser_func(f, path)
                 return
             elif os.path.isfile(path):
-                with open(path, "rb") as f:
+                with map_file(path) as f:
                     self.parser_func(f, path)
                 return
             elif os.path.isdir(path):
-                for walk_root, walk_dirs, walk_files in os.walk(path):
-                    for walk_file in fnmatch.filter(walk_files, self.ext_filter):
-                        fpath = os.path.join(walk_root, walk_file)
-                        with open(fpath, "rb") as f:
-                            self.parser_func(f, fpath)
+                self.parse_files(list(self.find_files(path)))
                 return
 
             e = "File path is not a file, directory or URL: %s" % (path)
@@ -302,6 +504,31 @@ class IOC_Parser(object):
             self.handler.print_error(path, e)
 
 
+def positive_int(value):
+    """Argument type for a number of at least one."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %s" % (value))
+    return number
+
+
+def init_worker(config):
+    """Create the parser of a worker process, with output going to a buffer."""
+    global worker_parser
+    sys.stdout = StringIO()
+    worker_parser = IOC_Parser(*config, workers=1)
+
+
+def parse_worker(fpath):
+    """Parse one file in a worker process and return its buffered output."""
+    worker_parser.parse_file(fpath)
+
+    output_data = sys.stdout.getvalue()
+    sys.stdout.seek(0)
+    sys.stdout.truncate(0)
+    return output_data
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
@@ -334,10 +561,22 @@ if __name__ == "__main__":
         default="pdfminer",
         help="PDF parsing library (pypdf2/pdfminer)",
     )
+    argparser.add_argument(
+        "-j",
+        dest="JOBS",
+        type=positive_int,
+        default=None,
+        help="Number of processes for directories (default: number of CPUs)",
+    )
 
     args = argparser.parse_args()
 
     parser = IOC_Parser(
-        args.INI, args.INPUT_FORMAT, args.OUTPUT_FORMAT, args.DEDUP, args.LIB
+        args.INI,
+        args.INPUT_FORMAT,
+        args.OUTPUT_FORMAT,
+        args.DEDUP,
+        args.LIB,
+        args.JOBS,
     )
     parser.parse(args.PATH)
@@ -1,18 +1,53 @@
 import os
 import sys
 import csv
+import functools
 import json
+import re
+
+# Use the much faster orjson for JSON output if available
+try:
+    import orjson
+
+    def json_dumps(data):
+        return orjson.dumps(data).decode("utf-8")
+
+except ImportError:
+    # Same compact, non-escaped output as orjson, which also refuses text
+    # that is not valid UTF-8
+    def json_dumps(data):
+        line = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        line.encode("utf-8")
+        return line
+
+
+# Escaped output for text that cannot be written as it is, such as file names
+# that are not valid UTF-8
+json_dumps_ascii = functools.partial(json.dumps, separators=(",", ":"))
 
 OUTPUT_FORMATS = ("csv", "json", "yara", "autofocus")
 
+# Rule names keep letters and digits, other characters become underscores
+RULE_ENC = str.maketrans(
+    dict(
+        (c, "_")
+        for c in range(256)
+        if not (chr(c).isupper() or chr(c).islower() or chr(c).isdigit())
+    )
+)
 
-def getHandler(output_format):
+
+def getFormat(output_format):
     output_format = output_format.lower()
     if output_format not in OUTPUT_FORMATS:
         print("[WARNING] Invalid output format specified.. using CSV")
         output_format = "csv"
 
-    handler_format = "OutputHandler_" + output_format
+    return output_format
+
+
+def getHandler(output_format):
+    handler_format = "OutputHandler_" + getFormat(output_format)
     handler_class = getattr(sys.modules[__name__], handler_format)
 
     return handler_class()
@@ -23,7 +58,8 @@ class OutputHandler(object):
         pass
 
     def print_header(self, fpath):
-        pass
+        # The file name is computed once per file
+        self.basename = os.path.basename(fpath)
 
     def print_footer(self, fpath):
         pass
@@ -33,46 +69,67 @@ class OutputHandler(object):
 
 
 class OutputHandler_csv(OutputHandler):
+    # Rows are written directly unless a field needs quoting
+    quote_chars = re.compile('["\r\n]')
+
     def __init__(self):
-        self.csv_writer = csv.writer(sys.stdout, delimiter="\t")
+        self.output = sys.stdout
+        self.csv_writer = csv.writer(self.output, delimiter="\t")
+        self.rows = []
+
+    def flush(self):
+        self.output.write("".join(self.rows))
+        del self.rows[:]
 
     def print_match(self, fpath, page, name, match):
-        self.csv_writer.writerow((fpath, page, name, match))
+        row = "\t".join((fpath, str(page), name, match))
+        if row.count("\t") != 3 or self.quote_chars.search(row):
+            self.flush()
+            self.csv_writer.writerow((fpath, page, name, match))
+            return
+
+        self.rows.append(row + "\r\n")
+        if len(self.rows) >= 1024:
+            self.flush()
+
+    def print_footer(self, fpath):
+        self.flush()
 
     def print_error(self, fpath, exception):
+        self.flush()
         self.csv_writer.writerow((fpath, "0", "error", exception))
 
 
 class OutputHandler_json(OutputHandler):
+    def write(self, data):
+        try:
+            sys.stdout.write(json_dumps(data) + "\n")
+        except (TypeError, UnicodeEncodeError):
+            sys.stdout.write(json_dumps_ascii(data) + "\n")
+
     def print_match(self, fpath, page, name, match):
         data = {
             "path": fpath,
-            "file": os.path.basename(fpath),
+            "file": self.basename,
             "page": page,
             "type": name,
             "match": match,
         }
 
-        print((json.dumps(data)))
+        self.write(data)
 
     def print_error(self, fpath, exception):
         data = {
             "path": fpath,
             "file": os.path.basename(fpath),
             "type": "error",
-            "exception": exception,
+            "exception": str(exception),
         }
 
-        print((json.dumps(data)))
+        self.write(data)
 
 
 class OutputHandler_yara(OutputHandler):
-    def __init__(self):
-        self.rule_enc = "".join(
-            chr(c) if chr(c).isupper() or chr(c).islower() or chr(c).isdigit() else "_"
-            for c in range(256)
-        )
-
     def print_match(self, fpath, page, name, match):
         if name in self.cnt:
             self.cnt[name] += 1
@@ -82,97 +139,58 @@ class OutputHandler_yara(OutputHandler):
         string_id = "$%s%d" % (name, self.cnt[name])
         self.sids.append(string_id)
         string_value = match.replace("\\", "\\\\")
-        print(('\t\t%s = "%s"' % (string_id, string_value)))
+        self.lines.append('\t\t%s = "%s"\n' % (string_id, string_value))
 
     def print_header(self, fpath):
-        rule_name = os.path.splitext(os.path.basename(fpath))[0].translate(
-            self.rule_enc
-        )
-
-        print(("rule %s" % (rule_name)))
-        print("{")
-        print("\tstrings:")
+        super().print_header(fpath)
+        self.rule_name = os.path.splitext(self.basename)[0].translate(RULE_ENC)
 
+        # The rule is collected and written in one go by print_footer
+        self.lines = ["rule %s\n{\n\tstrings:\n" % (self.rule_name)]
         self.cnt = {}
         self.sids = []
 
     def print_footer(self, fpath):
         cond = " or ".join(self.sids)
 
-        print("\tcondition:")
-        print(("\t\t" + cond))
-        print("}")
+        self.lines.append("\tcondition:\n\t\t%s\n}\n" % (cond))
+        sys.stdout.write("".join(self.lines))
 
 
 class OutputHandler_autofocus(OutputHandler):
-    def __init__(self):
-        self.rule_enc = "".join(
-            chr(c) if chr(c).isupper() or chr(c).islower() or chr(c).isdigit() else "_"
-            for c in range(256)
-        )
+    # AutoFocus query per indicator type, other types are not searched for
+    query_formats = {
+        "MD5": '{"field":"sample.md5","operator":"is","value":"%s"},',
+        "SHA1": '{"field":"sample.sha1","operator":"is","value":"%s"},',
+        "SHA256": '{"field":"sample.sha256","operator":"is","value":"%s"},',
+        "URL": '{"field":"sample.tasks.connection","operator":"contains","value":"%s"},',
+        "Host": '{"field":"sample.tasks.dns","operator":"contains","value":"%s"},',
+        # "Registry": '{"field":"sample.tasks.registry","operator":"is","value":\"%s\"},',
+        # "Filepath": '{"field":"sample.tasks.file","operator":"is","value":\"%s\"},',
+        # "Filename": '{"field":"alias.filename","operator":"is","value":\"%s\"},',
+        # "Email": '{"field":"alias.email","operator":"is","value":\"%s\"},',
+        "IP": '{"field":"sample.tasks.connection","operator":"contains","value":"%s"},',
+    }
 
     def print_match(self, fpath, page, name, match):
-        string_value = match.replace("hxxp", "http").replace("\\", "\\\\")
-
-        if name == "MD5":
-            auto_focus_query = (
-                '{"field":"sample.md5","operator":"is","value":"%s"},' % (string_value)
-            )
-        elif name == "SHA1":
-            auto_focus_query = (
-                '{"field":"sample.sha1","operator":"is","value":"%s"},' % (string_value)
-            )
-        elif name == "SHA256":
-            auto_focus_query = (
-                '{"field":"sample.sha256","operator":"is","value":"%s"},'
-                % (string_value)
-            )
-        elif name == "URL":
-            auto_focus_query = (
-                '{"field":"sample.tasks.connection","operator":"contains","value":"%s"},'
-                % (string_value)
-            )
-        elif name == "Host":
-            auto_focus_query = (
-                '{"field":"sample.tasks.dns","operator":"contains","value":"%s"},'
-                % (string_value)
-            )
-        elif name == "Registry":
-            # auto_focus_query = '{"field":"sample.tasks.registry","operator":"is","value":\"%s\"},' % (string_value)
-            return
-        elif name == "Filepath":
-            # auto_focus_query = '{"field":"sample.tasks.file","operator":"is","value":\"%s\"},' % (string_value)
-            return
-        elif name == "Filename":
-            # auto_focus_query = '{"field":"alias.filename","operator":"is","value":\"%s\"},' % (string_value)
-            return
-        elif name == "Email":
-            # auto_focus_query = '{"field":"alias.email","operator":"is","value":\"%s\"},' % (string_value)
-            return
-        elif name == "IP":
-            auto_focus_query = (
-                '{"field":"sample.tasks.connection","operator":"contains","value":"%s"},'
-                % (string_value)
-            )
-        elif name == "CVE":
+        query_format = self.query_formats.get(name)
+        if query_format is None:
             return
-        print(auto_focus_query)
+
+        string_value = match.replace("hxxp", "http").replace("\\", "\\\\")
+        print(query_format % (string_value))
 
     def print_header(self, fpath):
-        rule_name = os.path.splitext(os.path.basename(fpath))[0].translate(
-            self.rule_enc
-        )
+        super().print_header(fpath)
+        self.rule_name = os.path.splitext(self.basename)[0].translate(RULE_ENC)
 
-        print(("AutoFocus Search for: %s" % (rule_name)))
+        print(("AutoFocus Search for: %s" % (self.rule_name)))
         print('{"operator":"Any","children":[')
 
     def print_footer(self, fpath):
-        rule_name = os.path.splitext(os.path.basename(fpath))[0].translate(
-            self.rule_enc
-        )
         print(
             (
                 '{"field":"sample.tag","operator":"is in the list","value":["%s"]}]}'
-                % (rule_name)
+                % (self.rule_name)
             )
         )
@@ -4,10 +4,14 @@ import re
 
 
 class WhiteList(dict):
-    def __init__(self, basedir):
+    def __init__(self, basedir, re_compile=re.compile):
         searchdir = os.path.join(basedir, "whitelists/whitelist_*.ini")
         fpaths = glob.glob(searchdir)
         for fpath in fpaths:
             t = os.path.splitext(fpath)[0].split("_", 1)[1]
-            patterns = [line.strip() for line in open(fpath)]
-            self[t] = [re.compile(p) for p in patterns]
+            with open(fpath) as f:
+                patterns = [line.strip() for line in f if line.strip()]
+            # An empty alternation would match everything
+            if patterns:
+                pattern = "|".join("(?:%s)" % p for p in patterns)
+                self[t] = re_compile(pattern.encode("utf-8"))